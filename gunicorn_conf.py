@@ -0,0 +1,12 @@
+# Production server settings: gunicorn -c gunicorn_conf.py main:app
+import multiprocessing
+
+bind = "0.0.0.0:8000"
+
+# One event loop per core; UvicornWorker picks up uvloop and httptools when installed
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = multiprocessing.cpu_count()
+
+# Worker heartbeat timeout: a worker whose event loop stays blocked this long is restarted.
+# It does not limit how long a single request may take.
+timeout = 120
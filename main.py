@@ -1,20 +1,98 @@
 from fastapi import FastAPI, UploadFile, Form, HTTPException, BackgroundTasks, Depends, File
 from fastapi.middleware.cors import CORSMiddleware
-import requests
-import uuid
-from datetime import datetime, timedelta
+from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import asyncio
+import collections
+import httpx
+import secrets
+import hashlib
+import itertools
+import time
+from datetime import datetime, timedelta, timezone
 import logging
 import os
-import json
+import orjson
 import re
-import random
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, BinaryIO, Tuple
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# httpx logs every request URL at INFO, and Telegram URLs embed the bot token
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
-app = FastAPI(title="Instagram Clone - Complete Structure")
+# Upload limits
+MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB per media file
+MAX_POST_FILES = 10  # Instagram limit is 10 media items, same as a Telegram album
+MULTIPART_OVERHEAD = 64 * 1024  # Boundaries and form fields around the files
+ALLOWED_POST_TYPES = frozenset({'image/jpeg', 'image/png', 'image/gif', 'video/mp4', 'image/webp'})
+ALLOWED_STORY_TYPES = frozenset({'image/jpeg', 'image/png', 'video/mp4'})
+UPLOAD_BODY_LIMITS = {
+    "/upload-post/": MAX_POST_FILES * MAX_FILE_SIZE + MULTIPART_OVERHEAD,
+    "/upload-story/": MAX_FILE_SIZE + MULTIPART_OVERHEAD
+}
+
+# Shared Telegram HTTP client (keep-alive pool, created in lifespan)
+telegram_client: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open pooled HTTP clients on startup and close them on shutdown"""
+    global telegram_client
+    firebase_client.open()
+    telegram_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=30
+    )
+    try:
+        yield
+    finally:
+        await telegram_client.aclose()
+        await firebase_client.close()
+
+app = FastAPI(
+    title="Instagram Clone - Complete Structure",
+    lifespan=lifespan
+)
+
+class UploadSizeLimitMiddleware:
+    """Reject oversized upload bodies by Content-Length and while they stream in"""
+    
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+    
+    async def __call__(self, scope, receive, send):
+        max_body = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if max_body is None:
+            await self.app(scope, receive, send)
+            return
+        
+        # Honest clients are rejected before a single body byte is read
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > max_body:
+            response = JSONResponse(status_code=413, content={"detail": "Upload too large"})
+            await response(scope, receive, send)
+            return
+        
+        # Chunked or lying clients are cut off as soon as the limit is crossed
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body:
+                    raise HTTPException(status_code=413, detail="Upload too large")
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware, limits=UPLOAD_BODY_LIMITS)
 
 # CORS middleware
 app.add_middleware(
@@ -35,58 +113,186 @@ FIREBASE_CONFIG = {
 TELEGRAM_BOT_TOKENS = os.getenv("TELEGRAM_BOT_TOKENS", "").split(",")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
+# Bot API endpoints per token, built once instead of on every upload
+TELEGRAM_URLS = {
+    token: {
+        "sendPhoto": f"https://api.telegram.org/bot{token}/sendPhoto",
+        "sendVideo": f"https://api.telegram.org/bot{token}/sendVideo",
+        "sendDocument": f"https://api.telegram.org/bot{token}/sendDocument",
+        "sendMediaGroup": f"https://api.telegram.org/bot{token}/sendMediaGroup"
+    }
+    for token in (t.strip() for t in TELEGRAM_BOT_TOKENS) if token
+}
+
+# Per-process cap on Telegram requests in flight (not a requests/second rate limit;
+# each worker process has its own semaphore). 429s are handled by the retry logic below.
+TELEGRAM_UPLOAD_CONCURRENCY = 25
+TELEGRAM_MAX_ATTEMPTS = 3
+TELEGRAM_RETRY_BASE_DELAY = 0.5  # seconds, doubled on each retry
+TELEGRAM_MAX_RETRY_DELAY = 5  # seconds; longer flood-waits fail the upload instead
+TELEGRAM_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+telegram_upload_semaphore = asyncio.Semaphore(TELEGRAM_UPLOAD_CONCURRENCY)
+TELEGRAM_BREAKER_THRESHOLD = 10  # failed calls within the window that open the circuit
+TELEGRAM_BREAKER_WINDOW = 30  # seconds
+
 class TelegramUploadError(Exception):
     pass
 
+class CircuitBreaker:
+    """Fail fast for a cool-down period after repeated failures within a time window"""
+    
+    def __init__(self, threshold: int, window: float):
+        self.threshold = threshold
+        self.window = window
+        self.failures = collections.deque()
+        self.open_until = 0.0
+    
+    def is_open(self) -> bool:
+        return time.monotonic() < self.open_until
+    
+    def record_success(self):
+        self.failures.clear()
+    
+    def record_failure(self):
+        now = time.monotonic()
+        self.failures.append(now)
+        while self.failures and self.failures[0] < now - self.window:
+            self.failures.popleft()
+        if len(self.failures) >= self.threshold:
+            self.open_until = now + self.window
+            self.failures.clear()
+            logger.warning("Telegram circuit open for %ss after repeated failures", self.window)
+
+telegram_breaker = CircuitBreaker(TELEGRAM_BREAKER_THRESHOLD, TELEGRAM_BREAKER_WINDOW)
+
 class FirebaseError(Exception):
     pass
 
 class FirebaseRESTClient:
     def __init__(self, database_url):
         self.database_url = database_url.rstrip('/')
+        self._http: Optional[httpx.AsyncClient] = None
+    
+    def open(self):
+        """Create the pooled async HTTP client (called from lifespan)"""
+        self._http = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            headers={"Content-Type": "application/json"}
+        )
     
-    def set_data(self, path, data):
+    async def close(self):
+        """Close the pooled HTTP client"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+    
+    @staticmethod
+    def increment(delta=1):
+        """Server value that atomically adds delta to a numeric field"""
+        return {".sv": {"increment": delta}}
+    
+    async def get_data(self, path):
+        """Read data from Firebase using REST API"""
+        try:
+            url = f"{self.database_url}/{path}.json"
+            response = await self._http.get(url)
+            response.raise_for_status()
+            return orjson.loads(response.content)
+        except Exception as e:
+            logger.error("Firebase read failed: %s", e)
+            raise FirebaseError(f"Failed to read from Firebase: {e}")
+    
+    async def set_data(self, path, data):
         """Write data to Firebase using REST API"""
         try:
             url = f"{self.database_url}/{path}.json"
-            response = requests.put(url, json=data, timeout=10)
+            response = await self._http.put(url, content=orjson.dumps(data))
             response.raise_for_status()
             return True
         except Exception as e:
-            logger.error(f"Firebase write failed: {e}")
+            logger.error("Firebase write failed: %s", e)
             raise FirebaseError(f"Failed to write to Firebase: {e}")
     
-    def push_data(self, path, data):
+    async def push_data(self, path, data):
         """Push data to a list in Firebase"""
         try:
             url = f"{self.database_url}/{path}.json"
-            response = requests.post(url, json=data, timeout=10)
+            response = await self._http.post(url, content=orjson.dumps(data))
             response.raise_for_status()
-            return response.json().get('name')
+            return orjson.loads(response.content).get('name')
         except Exception as e:
-            logger.error(f"Firebase push failed: {e}")
+            logger.error("Firebase push failed: %s", e)
             raise FirebaseError(f"Failed to push to Firebase: {e}")
     
-    def update_data(self, path, data):
+    async def update_data(self, path, data):
         """Update specific fields in Firebase"""
         try:
             url = f"{self.database_url}/{path}.json"
-            response = requests.patch(url, json=data, timeout=10)
+            response = await self._http.patch(url, content=orjson.dumps(data))
             response.raise_for_status()
             return True
         except Exception as e:
-            logger.error(f"Firebase update failed: {e}")
+            logger.error("Firebase update failed: %s", e)
             raise FirebaseError(f"Failed to update Firebase: {e}")
+    
+    async def multi_update(self, updates):
+        """Atomically write several locations in one request (multi-path update)"""
+        try:
+            url = f"{self.database_url}/.json"
+            response = await self._http.patch(url, content=orjson.dumps(updates))
+            response.raise_for_status()
+            return True
+        except Exception as e:
+            logger.error("Firebase multi-path update failed: %s", e)
+            raise FirebaseError(f"Failed to update Firebase: {e}")
+
+class FirebaseBulkWriter:
+    """Buffer writes and flush them as chunked multi-path updates"""
+    
+    def __init__(self, client, chunk_size=500, max_concurrency=10):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+        self._updates = {}
+    
+    def add(self, path, data):
+        """Queue a write of data at path"""
+        self._updates[path] = data
+    
+    async def flush(self):
+        """Send queued writes, one request per chunk, with bounded concurrency"""
+        items = list(self._updates.items())
+        self._updates = {}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async def write_chunk(chunk):
+            async with semaphore:
+                await self.client.multi_update(dict(chunk))
+        
+        await asyncio.gather(*(
+            write_chunk(items[i:i + self.chunk_size])
+            for i in range(0, len(items), self.chunk_size)
+        ))
+        return len(items)
 
 # Initialize Firebase REST client
 firebase_client = FirebaseRESTClient(FIREBASE_CONFIG["database_url"])
 
-def get_random_bot_token():
-    """Get a random bot token from available bots"""
-    available_tokens = [token.strip() for token in TELEGRAM_BOT_TOKENS if token.strip()]
-    if not available_tokens:
+# Round-robin over the configured bots so uploads spread evenly across them
+bot_token_cycle = itertools.cycle(list(TELEGRAM_URLS))
+
+def next_bot_token():
+    """Get the next bot token in round-robin order"""
+    if not TELEGRAM_URLS:
         raise TelegramUploadError("No Telegram bot tokens available")
-    return random.choice(available_tokens)
+    return next(bot_token_cycle)
+
+@lru_cache(maxsize=10000)
+def default_avatar_url(user_id: str) -> str:
+    """Placeholder avatar for users without a profile picture"""
+    return f"https://api.dicebear.com/7.x/avataaars/svg?seed={user_id}"
 
 async def verify_user_token(token: str = Form(...)):
     """Basic user verification"""
@@ -110,6 +316,7 @@ async def create_user(
 ):
     """Create or update user profile"""
     try:
+        timestamp = datetime.now(timezone.utc).isoformat()
         user_data = {
             "user_id": user_id,
             "username": username.lower(),
@@ -117,7 +324,7 @@ async def create_user(
             "email": email,
             
             "profile": {
-                "profile_picture": profile_picture or f"https://api.dicebear.com/7.x/avataaars/svg?seed={user_id}",
+                "profile_picture": profile_picture or default_avatar_url(user_id),
                 "bio": bio,
                 "website": website,
                 "gender": "",
@@ -144,13 +351,13 @@ async def create_user(
             },
             
             "metadata": {
-                "created_at": datetime.utcnow().isoformat(),
-                "last_active": datetime.utcnow().isoformat(),
+                "created_at": timestamp,
+                "last_active": timestamp,
                 "last_post_at": None
             }
         }
         
-        firebase_client.set_data(f"users/{user_id}", user_data)
+        await firebase_client.set_data(f"users/{user_id}", user_data)
         
         return {
             "status": "success",
@@ -159,7 +366,7 @@ async def create_user(
         }
         
     except Exception as e:
-        logger.error(f"User creation failed: {e}")
+        logger.error("User creation failed: %s", e)
         raise HTTPException(status_code=500, detail="Failed to create user")
 
 # ===== POST MANAGEMENT =====
@@ -183,13 +390,16 @@ async def upload_post(
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
     
-    if len(files) > 10:  # Instagram limit is 10 media items
-        raise HTTPException(status_code=400, detail="Maximum 10 files allowed per post")
+    if len(files) > MAX_POST_FILES:
+        raise HTTPException(status_code=400, detail=f"Maximum {MAX_POST_FILES} files allowed per post")
     
     try:
         # Generate IDs and timestamps
-        post_id = str(uuid.uuid4())
-        timestamp = datetime.utcnow().isoformat()
+        post_id = generate_ulid()
+        now = datetime.now(timezone.utc)
+        timestamp = now.isoformat()
+        timestamp_ms = int(now.timestamp() * 1000)
+        hashtags = extract_hashtags(caption)
         
         # Build location data
         location_data = None
@@ -201,43 +411,18 @@ async def upload_post(
                 "lng": location_lng
             }
         
-        # Process all files and build media array
-        media_array = []
+        # Validate all files, then upload the valid ones as a single carousel
+        valid_files = []
         for order_index, file in enumerate(files):
-            # Validate file type for each file
-            allowed_types = ['image/jpeg', 'image/png', 'image/gif', 'video/mp4', 'image/webp']
-            if file.content_type not in allowed_types:
-                logger.warning(f"Skipping file {file.filename}: Invalid type {file.content_type}")
-                continue
-            
-            # Read file content
-            file_content = await file.read()
-            file_size = len(file_content)
-            
-            # Validate file size (10MB limit)
-            if file_size > 10 * 1024 * 1024:
-                logger.warning(f"Skipping file {file.filename}: File too large")
-                continue
-            
-            # Upload to Telegram using random bot
-            upload_result = await upload_to_telegram(file_content, file.filename, file.content_type)
-            
-            # Create media item
-            media_item = {
-                "media_id": str(uuid.uuid4()),
-                "file_unique_id": upload_result["file_unique_id"],
-                "media_type": "image" if file.content_type.startswith('image/') else "video",
-                "file_type": file.content_type,
-                "file_size": file_size,
-                "filename": file.filename,
-                "width": 1080,  # Would need image processing to get actual dimensions
-                "height": 1350,
-                "duration": None,  # Would need video processing
-                "thumbnail_url": upload_result.get("thumbnail_url", ""),
-                "order_index": order_index
-            }
-            
-            media_array.append(media_item)
+            file_size = validate_post_file(file)
+            if file_size is not None:
+                valid_files.append((order_index, file, file_size))
+        
+        upload_results = await upload_carousel([file for _, file, _ in valid_files])
+        media_array = [
+            build_media_item(order_index, file, file_size, upload_result)
+            for (order_index, file, file_size), upload_result in zip(valid_files, upload_results)
+        ]
         
         if not media_array:
             raise HTTPException(status_code=400, detail="No valid files to upload")
@@ -272,7 +457,8 @@ async def upload_post(
             
             "timestamps": {
                 "created_at": timestamp,
-                "updated_at": timestamp
+                "updated_at": timestamp,
+                "created_at_ms": timestamp_ms  # Numeric sort key for index entries
             },
             
             "settings": {
@@ -283,7 +469,7 @@ async def upload_post(
             },
             
             "discovery": {
-                "hashtags": extract_hashtags(caption),
+                "hashtags": hashtags,
                 "mentions": extract_mentions(caption),
                 "product_tags": []
             }
@@ -293,9 +479,7 @@ async def upload_post(
         await store_post_data(post_id, post_data, user_id)
         
         # Background tasks
-        background_tasks.add_task(update_user_counts, user_id, "posts", 1)
-        background_tasks.add_task(update_hashtags, extract_hashtags(caption), post_id)
-        background_tasks.add_task(update_user_last_post, user_id)
+        background_tasks.add_task(update_hashtags, hashtags, post_id)
         
         return {
             "status": "success", 
@@ -306,13 +490,13 @@ async def upload_post(
         }
         
     except TelegramUploadError as e:
-        logger.error(f"Telegram upload failed: {e}")
+        logger.error("Telegram upload failed: %s", e)
         raise HTTPException(status_code=500, detail="Failed to upload to Telegram")
     except FirebaseError as e:
-        logger.error(f"Firebase storage failed: {e}")
+        logger.error("Firebase storage failed: %s", e)
         raise HTTPException(status_code=500, detail="Failed to store post")
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
+        logger.error("Unexpected error: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 # ===== STORY MANAGEMENT =====
@@ -331,18 +515,15 @@ async def upload_story(
     """Upload a story with 24-hour expiration"""
     try:
         # Validate file type
-        allowed_types = ['image/jpeg', 'image/png', 'video/mp4']
-        if file.content_type not in allowed_types:
+        if file.content_type not in ALLOWED_STORY_TYPES:
             raise HTTPException(status_code=400, detail="File type not allowed for stories")
         
-        file_content = await file.read()
-        
-        # Upload to Telegram
-        upload_result = await upload_to_telegram(file_content, file.filename, file.content_type)
+        # Upload to Telegram (streamed, or reused if identical content was uploaded before)
+        upload_result = await upload_deduplicated(file.file, file.filename, file.content_type)
         
         # Story data with 24-hour expiration
-        story_id = str(uuid.uuid4())
-        created_at = datetime.utcnow()
+        story_id = secrets.token_hex(16)
+        created_at = datetime.now(timezone.utc)
         expires_at = (created_at + timedelta(hours=24)).isoformat()
         
         story_data = {
@@ -356,6 +537,8 @@ async def upload_story(
             
             "media": {
                 "file_unique_id": upload_result["file_unique_id"],
+                "file_id": upload_result["file_id"],
+                "bot_id": upload_result["bot_id"],
                 "media_type": "image" if file.content_type.startswith('image/') else "video",
                 "duration": 15,  # Default, would need actual video duration
                 "thumbnail_url": upload_result.get("thumbnail_url", "")
@@ -392,7 +575,7 @@ async def upload_story(
         }
         
         # Store story
-        firebase_client.set_data(f"stories/{user_id}/{story_id}", story_data)
+        await firebase_client.set_data(f"stories/{user_id}/{story_id}", story_data)
         
         return {
             "status": "success",
@@ -402,13 +585,14 @@ async def upload_story(
         }
         
     except Exception as e:
-        logger.error(f"Story upload failed: {e}")
+        logger.error("Story upload failed: %s", e)
         raise HTTPException(status_code=500, detail="Failed to upload story")
 
 # ===== ENGAGEMENT ACTIONS =====
 
 @app.post("/like-post/")
 async def like_post(
+    background_tasks: BackgroundTasks,
     user_id: str = Form(...),
     username: str = Form(...),
     profile_picture: str = Form(...),
@@ -418,7 +602,7 @@ async def like_post(
 ):
     """Like a post"""
     try:
-        like_id = str(uuid.uuid4())
+        like_id = secrets.token_hex(16)
         like_data = {
             "like_id": like_id,
             "post_id": post_id,
@@ -429,15 +613,15 @@ async def like_post(
                 "profile_picture": profile_picture
             },
             
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
             "type": like_type
         }
         
-        # Store like
-        firebase_client.set_data(f"likes/{post_id}/{like_id}", like_data)
-        
-        # Increment like count
-        firebase_client.update_data(f"posts/{post_id}/engagement", {"like_count": "INCREMENT"})
+        # Store like and increment like count in one atomic write
+        await firebase_client.multi_update({
+            f"likes/{post_id}/{like_id}": like_data,
+            f"posts/{post_id}/engagement/like_count": firebase_client.increment(1)
+        })
         
         # Create activity notification
         background_tasks.add_task(create_activity, post_id, user_id, username, "like", post_id)
@@ -449,11 +633,12 @@ async def like_post(
         }
         
     except Exception as e:
-        logger.error(f"Like failed: {e}")
+        logger.error("Like failed: %s", e)
         raise HTTPException(status_code=500, detail="Failed to like post")
 
 @app.post("/add-comment/")
 async def add_comment(
+    background_tasks: BackgroundTasks,
     user_id: str = Form(...),
     username: str = Form(...),
     profile_picture: str = Form(...),
@@ -464,7 +649,8 @@ async def add_comment(
 ):
     """Add a comment to a post"""
     try:
-        comment_id = str(uuid.uuid4())
+        comment_id = secrets.token_hex(16)
+        timestamp = datetime.now(timezone.utc).isoformat()
         comment_data = {
             "comment_id": comment_id,
             "post_id": post_id,
@@ -482,8 +668,8 @@ async def add_comment(
             },
             
             "timestamps": {
-                "created_at": datetime.utcnow().isoformat(),
-                "updated_at": datetime.utcnow().isoformat()
+                "created_at": timestamp,
+                "updated_at": timestamp
             },
             
             "engagement": {
@@ -498,11 +684,11 @@ async def add_comment(
             }
         }
         
-        # Store comment
-        firebase_client.set_data(f"comments/{post_id}/{comment_id}", comment_data)
-        
-        # Increment comment count
-        firebase_client.update_data(f"posts/{post_id}/engagement", {"comment_count": "INCREMENT"})
+        # Store comment and increment comment count in one atomic write
+        await firebase_client.multi_update({
+            f"comments/{post_id}/{comment_id}": comment_data,
+            f"posts/{post_id}/engagement/comment_count": firebase_client.increment(1)
+        })
         
         # Create activity notification
         background_tasks.add_task(create_activity, post_id, user_id, username, "comment", post_id, text)
@@ -514,11 +700,12 @@ async def add_comment(
         }
         
     except Exception as e:
-        logger.error(f"Comment failed: {e}")
+        logger.error("Comment failed: %s", e)
         raise HTTPException(status_code=500, detail="Failed to add comment")
 
 @app.post("/follow-user/")
 async def follow_user(
+    background_tasks: BackgroundTasks,
     follower_id: str = Form(...),
     follower_username: str = Form(...),
     following_id: str = Form(...),
@@ -527,7 +714,7 @@ async def follow_user(
 ):
     """Follow a user"""
     try:
-        follow_id = str(uuid.uuid4())
+        follow_id = secrets.token_hex(16)
         follow_data = {
             "follow_id": follow_id,
             "follower_id": follower_id,
@@ -535,17 +722,17 @@ async def follow_user(
             
             "follower_info": {
                 "username": follower_username,
-                "profile_picture": f"https://api.dicebear.com/7.x/avataaars/svg?seed={follower_id}"
+                "profile_picture": default_avatar_url(follower_id)
             },
             
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
             "status": "active",
             "notifications": True,
             "is_close_friend": is_close_friend
         }
         
         # Store follow relationship
-        firebase_client.set_data(f"follows/{follower_id}_{following_id}", follow_data)
+        await firebase_client.set_data(f"follows/{follower_id}_{following_id}", follow_data)
         
         # Update user counts
         background_tasks.add_task(update_user_counts, follower_id, "following", 1)
@@ -561,121 +748,301 @@ async def follow_user(
         }
         
     except Exception as e:
-        logger.error(f"Follow failed: {e}")
+        logger.error("Follow failed: %s", e)
         raise HTTPException(status_code=500, detail="Failed to follow user")
 
 # ===== HELPER FUNCTIONS =====
 
-async def upload_to_telegram(file_content: bytes, filename: str, content_type: str) -> Dict[str, Any]:
-    """Upload media to Telegram using random bot and return file info"""
+def validate_post_file(file: UploadFile) -> Optional[int]:
+    """Return the size of a valid carousel file, or None if it should be skipped"""
+    # Validate file type for each file
+    if file.content_type not in ALLOWED_POST_TYPES:
+        logger.warning("Skipping file %s: Invalid type %s", file.filename, file.content_type)
+        return None
+    
+    # Size comes from the spooled upload; the body is streamed, not buffered
+    file_size = get_upload_size(file)
+    
+    # Validate file size (10MB limit)
+    if file_size > MAX_FILE_SIZE:
+        logger.warning("Skipping file %s: File too large", file.filename)
+        return None
+    
+    return file_size
+
+def build_media_item(order_index: int, file: UploadFile, file_size: int, upload_result: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the stored media item for one uploaded carousel file"""
+    return {
+        "media_id": secrets.token_hex(16),
+        "file_unique_id": upload_result["file_unique_id"],
+        "file_id": upload_result["file_id"],
+        "bot_id": upload_result["bot_id"],
+        "media_type": "image" if file.content_type.startswith('image/') else "video",
+        "file_type": file.content_type,
+        "file_size": file_size,
+        "filename": file.filename,
+        "width": 1080,  # Would need image processing to get actual dimensions
+        "height": 1350,
+        "duration": None,  # Would need video processing
+        "thumbnail_url": upload_result.get("thumbnail_url", ""),
+        "order_index": order_index
+    }
+
+def get_upload_size(file: UploadFile) -> int:
+    """Return the size of an uploaded file without reading it into memory"""
+    if file.size is not None:
+        return file.size
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
+
+def hash_upload(file_obj: BinaryIO, content_type: str) -> str:
+    """BLAKE2b digest of an upload's content type and bytes, read in chunks"""
+    digest = hashlib.blake2b(content_type.encode(), digest_size=16)
+    file_obj.seek(0)
+    for chunk in iter(lambda: file_obj.read(64 * 1024), b""):
+        digest.update(chunk)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+async def find_existing_upload(file_obj: BinaryIO, content_type: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Hash an upload and return the digest with the Telegram file of identical earlier content, if any"""
+    content_hash = await asyncio.to_thread(hash_upload, file_obj, content_type)
+    try:
+        return content_hash, await firebase_client.get_data(f"media_hashes/{content_hash}")
+    except FirebaseError:
+        return content_hash, None  # Dedup is an optimization; fall through to a normal upload
+
+async def remember_upload(content_hash: str, upload_result: Dict[str, Any]):
+    """Index a Telegram upload by content hash so identical files can reuse it"""
+    try:
+        await firebase_client.set_data(f"media_hashes/{content_hash}", upload_result)
+    except FirebaseError:
+        pass
+
+async def upload_deduplicated(file_obj: BinaryIO, filename: str, content_type: str) -> Dict[str, Any]:
+    """Reuse the Telegram file of an identical earlier upload, else upload and index it"""
+    content_hash, existing = await find_existing_upload(file_obj, content_type)
+    if existing:
+        return existing
+    
+    upload_result = await upload_to_telegram(file_obj, filename, content_type)
+    await remember_upload(content_hash, upload_result)
+    return upload_result
+
+async def upload_carousel(files: List[UploadFile]) -> List[Dict[str, Any]]:
+    """Upload carousel files in order, reusing known content and sending new files as one media group"""
+    lookups = await asyncio.gather(*(find_existing_upload(file.file, file.content_type) for file in files))
+    results = [existing for _, existing in lookups]
+    pending = [index for index, existing in enumerate(results) if not existing]
+    
+    if len(pending) == 1:
+        file = files[pending[0]]
+        new_results = [await upload_to_telegram(file.file, file.filename, file.content_type)]
+    elif pending:
+        new_results = await upload_media_group_to_telegram([files[index] for index in pending])
+    else:
+        new_results = []
+    
+    for index, upload_result in zip(pending, new_results):
+        results[index] = upload_result
+    await asyncio.gather(*(remember_upload(lookups[index][0], results[index]) for index in pending))
+    return results
+
+def telegram_retry_delay(response: httpx.Response, attempt: int) -> float:
+    """Seconds to wait before a retry: Telegram's retry_after if given, else exponential backoff"""
+    try:
+        retry_after = orjson.loads(response.content).get("parameters", {}).get("retry_after")
+    except (orjson.JSONDecodeError, AttributeError):
+        retry_after = None
+    return retry_after or TELEGRAM_RETRY_BASE_DELAY * 2 ** attempt
+
+async def post_to_telegram(url: str, files: Dict[str, Any], data: Dict[str, Any]) -> httpx.Response:
+    """POST to the Bot API, failing fast while the Telegram circuit is open"""
+    if telegram_breaker.is_open():
+        raise TelegramUploadError("Telegram is unavailable, try again shortly")
+    
+    try:
+        response = await send_to_telegram(url, files, data)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code in TELEGRAM_RETRY_STATUSES:
+            telegram_breaker.record_failure()
+        raise
+    except httpx.TransportError:
+        telegram_breaker.record_failure()
+        raise
+    telegram_breaker.record_success()
+    return response
+
+async def send_to_telegram(url: str, files: Dict[str, Any], data: Dict[str, Any]) -> httpx.Response:
+    """Send one Bot API request with retries; a concurrency slot is held only while a request is in flight"""
+    for attempt in range(TELEGRAM_MAX_ATTEMPTS):
+        is_last_attempt = attempt == TELEGRAM_MAX_ATTEMPTS - 1
+        # Rewind so a retry resends every file in full
+        for _, file_obj, _ in files.values():
+            file_obj.seek(0)
+        try:
+            async with telegram_upload_semaphore:
+                response = await telegram_client.post(url, files=files, data=data)
+        except httpx.TransportError:
+            if is_last_attempt:
+                raise
+            await asyncio.sleep(TELEGRAM_RETRY_BASE_DELAY * 2 ** attempt)
+            continue
+        
+        if response.status_code not in TELEGRAM_RETRY_STATUSES or is_last_attempt:
+            response.raise_for_status()
+            return response
+        
+        delay = telegram_retry_delay(response, attempt)
+        if delay > TELEGRAM_MAX_RETRY_DELAY:
+            raise TelegramUploadError(f"Telegram asked to retry after {delay}s")
+        await asyncio.sleep(delay)
+
+def extract_file_info(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Pull the file ids out of a sent Telegram message"""
+    file_info = {}
+    if 'photo' in message:
+        photo = message["photo"][-1]
+        file_info["file_unique_id"] = photo["file_unique_id"]
+        file_info["file_id"] = photo["file_id"]
+    elif 'document' in message:
+        document = message["document"]
+        file_info["file_unique_id"] = document["file_unique_id"]
+        file_info["file_id"] = document["file_id"]
+    elif 'video' in message:
+        video = message["video"]
+        file_info["file_unique_id"] = video["file_unique_id"]
+        file_info["file_id"] = video["file_id"]
+    else:
+        raise TelegramUploadError("No file found in Telegram response")
+    return file_info
+
+async def upload_to_telegram(file_obj: BinaryIO, filename: str, content_type: str) -> Dict[str, Any]:
+    """Upload media to Telegram using the next bot in rotation and return file info"""
     try:
-        bot_token = get_random_bot_token()
+        bot_token = next_bot_token()
         
         if content_type.startswith('image/'):
-            url = f"https://api.telegram.org/bot{bot_token}/sendPhoto"
-            files = {"photo": (filename, file_content, content_type)}
+            url = TELEGRAM_URLS[bot_token]["sendPhoto"]
+            files = {"photo": (filename, file_obj, content_type)}
+        elif content_type.startswith('video/'):
+            # Same Telegram object as a video sent inside a carousel album
+            url = TELEGRAM_URLS[bot_token]["sendVideo"]
+            files = {"video": (filename, file_obj, content_type)}
         else:
-            url = f"https://api.telegram.org/bot{bot_token}/sendDocument"
-            files = {"document": (filename, file_content, content_type)}
+            url = TELEGRAM_URLS[bot_token]["sendDocument"]
+            files = {"document": (filename, file_obj, content_type)}
         
         data = {"chat_id": TELEGRAM_CHAT_ID} if TELEGRAM_CHAT_ID else {}
         
-        response = requests.post(url, files=files, data=data, timeout=30)
-        response.raise_for_status()
+        response = await post_to_telegram(url, files, data)
         
-        result = response.json()
+        result = orjson.loads(response.content)
         if not result.get("ok"):
             raise TelegramUploadError(f"Telegram API error: {result}")
         
-        # Extract file information
-        file_info = {}
-        if 'photo' in result["result"]:
-            photo = result["result"]["photo"][-1]
-            file_info["file_unique_id"] = photo["file_unique_id"]
-            file_info["file_id"] = photo["file_id"]
-        elif 'document' in result["result"]:
-            document = result["result"]["document"]
-            file_info["file_unique_id"] = document["file_unique_id"]
-            file_info["file_id"] = document["file_id"]
-        elif 'video' in result["result"]:
-            video = result["result"]["video"]
-            file_info["file_unique_id"] = video["file_unique_id"]
-            file_info["file_id"] = video["file_id"]
-        else:
-            raise TelegramUploadError("No file found in Telegram response")
+        file_info = extract_file_info(result["result"])
+        
+        # file_id is only valid for the bot that uploaded it; the bot id is the public part of the token
+        file_info["bot_id"] = bot_token.split(":", 1)[0]
         
         return file_info
                 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
+        raise TelegramUploadError(f"Network error: {e}")
+
+async def upload_media_group_to_telegram(files: List[UploadFile]) -> List[Dict[str, Any]]:
+    """Upload 2-10 files as one Telegram album (sendMediaGroup) and return file info in order"""
+    try:
+        bot_token = next_bot_token()
+        
+        media = []
+        attachments = {}
+        for index, file in enumerate(files):
+            attach_name = f"file{index}"
+            media.append({
+                "type": "photo" if file.content_type.startswith('image/') else "video",
+                "media": f"attach://{attach_name}"
+            })
+            attachments[attach_name] = (file.filename, file.file, file.content_type)
+        
+        data = {"media": orjson.dumps(media).decode()}
+        if TELEGRAM_CHAT_ID:
+            data["chat_id"] = TELEGRAM_CHAT_ID
+        
+        response = await post_to_telegram(TELEGRAM_URLS[bot_token]["sendMediaGroup"], attachments, data)
+        
+        result = orjson.loads(response.content)
+        if not result.get("ok"):
+            raise TelegramUploadError(f"Telegram API error: {result}")
+        
+        bot_id = bot_token.split(":", 1)[0]
+        return [dict(extract_file_info(message), bot_id=bot_id) for message in result["result"]]
+                
+    except httpx.HTTPError as e:
         raise TelegramUploadError(f"Network error: {e}")
 
 async def store_post_data(post_id: str, post_data: dict, user_id: str):
     """Store post data in multiple locations for efficient querying"""
     try:
-        # Store in main posts collection
-        firebase_client.set_data(f"posts/{post_id}", post_data)
-        
-        # Store in user's posts collection
-        firebase_client.set_data(f"user_posts/{user_id}/{post_id}", {
-            "post_id": post_id,
-            "timestamp": post_data["timestamps"]["created_at"]
-        })
+        created_at = post_data["timestamps"]["created_at"]
+        created_at_ms = post_data["timestamps"]["created_at_ms"]
         
-        # Add to global timeline
-        firebase_client.push_data("timeline", {
-            "post_id": post_id,
-            "user_id": user_id,
-            "timestamp": post_data["timestamps"]["created_at"],
-            "score": 1.0  # For feed ranking
+        # Post, user index, timeline entry and user stats in one atomic write
+        await firebase_client.multi_update({
+            f"posts/{post_id}": post_data,
+            f"user_posts/{user_id}/{post_id}": {
+                "post_id": post_id,
+                "timestamp": created_at_ms
+            },
+            f"timeline/{generate_push_id(created_at_ms)}": {
+                "post_id": post_id,
+                "user_id": user_id,
+                "timestamp": created_at_ms,
+                "score": 1.0  # For feed ranking
+            },
+            f"users/{user_id}/counts/posts": firebase_client.increment(1),
+            f"users/{user_id}/metadata/last_post_at": created_at,
+            f"users/{user_id}/metadata/last_active": created_at
         })
         
-        logger.info(f"✅ Post {post_id} stored in Firebase with {len(post_data['media'])} media items")
+        logger.info("✅ Post %s stored in Firebase with %s media items", post_id, len(post_data['media']))
         
     except Exception as e:
-        logger.error(f"Post storage error: {e}")
+        logger.error("Post storage error: %s", e)
         raise FirebaseError(f"Failed to store post: {e}")
 
 async def update_user_counts(user_id: str, count_type: str, delta: int):
     """Update user engagement counts"""
     try:
-        firebase_client.update_data(f"users/{user_id}/counts", {count_type: "INCREMENT"})
-    except Exception as e:
-        logger.error(f"User count update failed: {e}")
-
-async def update_user_last_post(user_id: str):
-    """Update user's last post timestamp"""
-    try:
-        firebase_client.update_data(f"users/{user_id}/metadata", {
-            "last_post_at": datetime.utcnow().isoformat(),
-            "last_active": datetime.utcnow().isoformat()
-        })
+        await firebase_client.update_data(f"users/{user_id}/counts", {count_type: firebase_client.increment(delta)})
     except Exception as e:
-        logger.error(f"User last post update failed: {e}")
+        logger.error("User count update failed: %s", e)
 
 async def update_hashtags(hashtags: List[str], post_id: str):
     """Update hashtag collections"""
     try:
-        for hashtag in hashtags:
-            hashtag_lower = hashtag.lower()
-            hashtag_data = {
-                "hashtag": hashtag_lower,
-                "metadata": {
-                    "post_count": "INCREMENT",
-                    "last_used": datetime.utcnow().isoformat(),
-                    "is_featured": False,
-                    "is_banned": False
-                }
-            }
-            firebase_client.set_data(f"hashtags/{hashtag_lower}", hashtag_data)
-            
+        last_used = datetime.now(timezone.utc).isoformat()
+        writer = FirebaseBulkWriter(firebase_client)
+        # A tag repeated in one caption counts once
+        for hashtag_lower in {hashtag.lower() for hashtag in hashtags}:
+            # Nested paths so the counter is incremented, not replaced. metadata/is_featured and
+            # metadata/is_banned are only set by moderation; readers treat a missing flag as False.
+            writer.add(f"hashtags/{hashtag_lower}/hashtag", hashtag_lower)
+            writer.add(f"hashtags/{hashtag_lower}/metadata/post_count", firebase_client.increment(1))
+            writer.add(f"hashtags/{hashtag_lower}/metadata/last_used", last_used)
+        
+        await writer.flush()
     except Exception as e:
-        logger.error(f"Hashtag update failed: {e}")
+        logger.error("Hashtag update failed: %s", e)
 
 async def create_activity(target_user_id: str, actor_user_id: str, actor_username: str, 
                          activity_type: str, target_id: str, text: str = None):
     """Create activity notification"""
     try:
-        activity_id = str(uuid.uuid4())
+        activity_id = secrets.token_hex(16)
         activity_data = {
             "activity_id": activity_id,
             "user_id": target_user_id,  # Who should receive the notification
@@ -684,7 +1051,7 @@ async def create_activity(target_user_id: str, actor_user_id: str, actor_usernam
             "actor_id": actor_user_id,
             "actor_info": {
                 "username": actor_username,
-                "profile_picture": f"https://api.dicebear.com/7.x/avataaars/svg?seed={actor_user_id}"
+                "profile_picture": default_avatar_url(actor_user_id)
             },
             
             "target": {
@@ -693,23 +1060,48 @@ async def create_activity(target_user_id: str, actor_user_id: str, actor_usernam
                 "preview": text or f"{actor_username} {activity_type}d your post"
             },
             
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
             "is_read": False,
             "is_hidden": False
         }
         
-        firebase_client.push_data(f"activities/{target_user_id}", activity_data)
+        await firebase_client.push_data(f"activities/{target_user_id}", activity_data)
         
     except Exception as e:
-        logger.error(f"Activity creation failed: {e}")
+        logger.error("Activity creation failed: %s", e)
+
+CROCKFORD_BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+def generate_ulid() -> str:
+    """Generate a ULID: 48-bit ms timestamp + 80 random bits, sortable by creation time"""
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    chars = []
+    for _ in range(26):
+        chars.append(CROCKFORD_BASE32[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+def generate_push_id(timestamp_ms: int) -> str:
+    """Generate a Firebase-style push key: 48-bit ms timestamp + 72 random bits, in push-key order"""
+    value = timestamp_ms << 72 | int.from_bytes(os.urandom(9), "big")
+    chars = []
+    for _ in range(20):
+        chars.append(PUSH_CHARS[value & 63])
+        value >>= 6
+    return "".join(reversed(chars))
+
+HASHTAG_PATTERN = re.compile(r'#(\w+)')
+MENTION_PATTERN = re.compile(r'@(\w+)')
 
 def extract_hashtags(text: str) -> List[str]:
     """Extract hashtags from text"""
-    return re.findall(r'#(\w+)', text)
+    return HASHTAG_PATTERN.findall(text)
 
 def extract_mentions(text: str) -> List[str]:
     """Extract mentions from text"""
-    return re.findall(r'@(\w+)', text)
+    return MENTION_PATTERN.findall(text)
 
 # ===== HEALTH & INFO =====
 
@@ -719,7 +1111,7 @@ async def health_check():
     return {
         "status": "healthy", 
         "service": "Instagram Clone - Complete Structure",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
         "active_bots": len([t for t in TELEGRAM_BOT_TOKENS if t.strip()])
     }
 
@@ -737,11 +1129,12 @@ async def root():
             "engagement": ["/like-post/", "/add-comment/", "/follow-user/"]
         },
         "data_collections": [
-            "users", "posts", "stories", "comments", "likes", 
-            "follows", "activities", "hashtags", "timeline"
+            "users", "posts", "user_posts", "stories", "comments", "likes", 
+            "follows", "activities", "hashtags", "timeline", "media_hashes"
         ]
     }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Workers need an import string; each one opens its own pooled clients in lifespan
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=os.cpu_count())